@@ -4,106 +4,198 @@
 import pandas as pd
 from pyphetools.creation import Individual, MetaData, HpTerm, Disease, Citation, HgvsVariant
 from phenopackets.schema.v2.core.interpretation_pb2 import VariantInterpretation
+from phenopackets.schema.v2.phenopackets_pb2 import Phenopacket
 from pyphetools.validation import ContentValidator
-from google.protobuf.json_format import MessageToJson
-import os
+from google.protobuf.json_format import MessageToJson, Parse
 import re
+import os
+import sys
 import argparse
+import multiprocessing
 from collections import Counter
+from dataclasses import dataclass, field
+from itertools import zip_longest
+from pathlib import Path
+from typing import List, Optional
+
+# Prefixes that mark the first colon-separated part as something other than a gene symbol.
+NON_SYMBOL_PREFIXES = ('NM_', 'NR_', 'c.', 'g.', 'p.', 'chr', 'NC_')
+TRANSCRIPT_PREFIXES = ('NM_', 'NR_')
+
+@dataclass(slots=True)
+class _VarParts:
+    """Components of a parsed variant string."""
+    symbol: Optional[str] = None
+    transcript: Optional[str] = None
+    genomic: Optional[str] = None
+    protein: Optional[str] = None
+    cdna: Optional[str] = None
+    other: List[str] = field(default_factory=list)
 
-def extract_gene_symbol(variant_string):
+def _classify_expression(expr, components):
     """
-    Extracts the gene symbol from a variant string.
-    Common patterns:
-    - GENE:NM_xxx:c.xxx
-    - GENE:p.xxx
-    - Just returns None if no clear gene symbol
+    Assigns the parts of a single HGVS-like expression to the matching fields of components.
     """
-    if ':' in variant_string:
-        parts = variant_string.split(':')
-        # First part is often the gene symbol if it doesn't start with known prefixes
-        first_part = parts[0].strip()
-        if not any(first_part.startswith(prefix) for prefix in ['NM_', 'NR_', 'c.', 'g.', 'p.', 'chr', 'NC_']):
-            # Likely a gene symbol
-            return first_part
-    return None
+    if ':' in expr:
+        parts = expr.split(':', 2)
+
+        # Check first part
+        first = parts[0].strip()
+        # Gene symbol check
+        if not first.startswith(NON_SYMBOL_PREFIXES):
+            components.symbol = first
+        elif first.startswith(TRANSCRIPT_PREFIXES):
+            components.transcript = first
+
+        # Check second part if exists
+        if len(parts) >= 2:
+            second = parts[1].strip()
+            if second.startswith(TRANSCRIPT_PREFIXES):
+                components.transcript = second
+            elif second.startswith('c.'):
+                components.cdna = second
+            elif second.startswith('g.'):
+                components.genomic = second
+            elif second.startswith('p.'):
+                components.protein = second
+
+        # Check third part if exists
+        if len(parts) >= 3:
+            third = parts[2].strip()
+            if third.startswith('c.'):
+                components.cdna = third
+            elif third.startswith('g.'):
+                components.genomic = third
+            elif third.startswith('p.'):
+                components.protein = third
+    else:
+        # Single expression without colons
+        if expr.startswith('p.'):
+            components.protein = expr
+        elif expr.startswith('g.'):
+            components.genomic = expr
+        elif expr.startswith('c.'):
+            components.cdna = expr
+        elif expr.startswith(TRANSCRIPT_PREFIXES):
+            components.transcript = expr
+        else:
+            components.other.append(expr)
 
 def parse_variant_components(variant_string):
     """
     Parses a variant string to extract gene symbol, transcript, and HGVS expressions.
-    Returns a dict with 'symbol', 'transcript', 'genomic', 'protein', and 'other' components.
+    Returns a _VarParts with 'symbol', 'transcript', 'genomic', 'protein', 'cdna', and 'other' components.
     """
-    components = {
-        'symbol': None,
-        'transcript': None,
-        'genomic': None,
-        'protein': None,
-        'cdna': None,
-        'other': []
-    }
-    
+    components = _VarParts()
+
+    # Most variants carry a single expression, so skip the split-and-loop in that case
+    if ',' not in variant_string:
+        _classify_expression(variant_string.strip(), components)
+        return components
+
     # Handle comma-separated expressions (same variant, different representations)
-    expressions = [e.strip() for e in variant_string.split(',')]
-    
-    for expr in expressions:
-        if ':' in expr:
-            parts = expr.split(':', 2)
-            
-            # Check first part
-            if len(parts) >= 1:
-                first = parts[0].strip()
-                # Gene symbol check
-                if not any(first.startswith(prefix) for prefix in ['NM_', 'NR_', 'c.', 'g.', 'p.', 'chr', 'NC_']):
-                    components['symbol'] = first
-                elif first.startswith(('NM_', 'NR_')):
-                    components['transcript'] = first
-                    
-            # Check second part if exists
-            if len(parts) >= 2:
-                second = parts[1].strip()
-                if second.startswith(('NM_', 'NR_')):
-                    components['transcript'] = second
-                elif second.startswith('c.'):
-                    components['cdna'] = second
-                elif second.startswith('g.'):
-                    components['genomic'] = second
-                elif second.startswith('p.'):
-                    components['protein'] = second
-                    
-            # Check third part if exists
-            if len(parts) >= 3:
-                third = parts[2].strip()
-                if third.startswith('c.'):
-                    components['cdna'] = third
-                elif third.startswith('g.'):
-                    components['genomic'] = third
-                elif third.startswith('p.'):
-                    components['protein'] = third
-        else:
-            # Single expression without colons
-            if expr.startswith('p.'):
-                components['protein'] = expr
-            elif expr.startswith('g.'):
-                components['genomic'] = expr
-            elif expr.startswith('c.'):
-                components['cdna'] = expr
-            elif expr.startswith(('NM_', 'NR_')):
-                components['transcript'] = expr
-            else:
-                components['other'].append(expr)
-    
+    for expr in variant_string.split(','):
+        _classify_expression(expr.strip(), components)
+
     return components
 
-def create_phenopackets(parsed_data_path, output_dir):
+def write_length_delimited(phenopackets, output_path):
     """
-    Generates PhenoPacket JSON files from a structured DataFrame.
+    Writes PhenoPacket messages to a single binary file, each serialized message
+    prefixed by its length as a 4-byte little-endian integer.
+    """
+    with open(output_path, 'wb') as f:
+        for phenopacket in phenopackets:
+            data = phenopacket.SerializeToString()
+            f.write(len(data).to_bytes(4, 'little'))
+            f.write(data)
+
+def write_parquet(phenopackets, output_path):
+    """
+    Writes PhenoPacket messages to a Parquet file with one row per PhenoPacket:
+    the id, the subject as JSON, and the serialized protobuf message.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    table = pa.table({
+        'id': [pp.id for pp in phenopackets],
+        'subject_json': [MessageToJson(pp.subject) for pp in phenopackets],
+        'payload': pa.array([pp.SerializeToString() for pp in phenopackets], type=pa.binary()),
+    })
+    pq.write_table(table, output_path)
+
+def read_length_delimited(input_path):
+    """
+    Yields the serialized PhenoPacket messages of a file written by write_length_delimited.
+    """
+    with open(input_path, 'rb') as f:
+        while header := f.read(4):
+            yield f.read(int.from_bytes(header, 'little'))
+
+def read_parquet(input_path):
+    """
+    Returns the serialized PhenoPacket messages of a file written by write_parquet.
+    """
+    import pyarrow.parquet as pq
+
+    return pq.read_table(input_path, columns=['payload']).column('payload').to_pylist()
+
+def _validate_one(source):
+    """
+    Validates one PhenoPacket, given as a JSON file path or a serialized message, with
+    the same ContentValidator settings as inline validation. Returns its id and errors.
+    """
+    phenopacket = Phenopacket()
+    if isinstance(source, bytes):
+        phenopacket.ParseFromString(source)
+    else:
+        with open(source) as f:
+            Parse(f.read(), phenopacket)
+
+    errors = ContentValidator(min_hpo=0).validate_phenopacket(phenopacket)
+    # Individuals without a disease annotation are expected, as in create_phenopackets
+    if not phenopacket.diseases:
+        errors = [e for e in errors if "disease annotation" not in e.message]
+    return phenopacket.id, [e.message for e in errors]
+
+def validate_output_dir(output_dir, output_format='json', workers=None):
+    """
+    Validates the PhenoPackets written by create_phenopackets to output_dir in the
+    given format, spreading them over worker processes. Returns True if all are valid.
+    """
+    out = Path(output_dir)
+    if output_format == 'json':
+        sources = sorted(str(path) for path in out.glob('PAVS_*.json'))
+    elif output_format == 'pb':
+        sources = list(read_length_delimited(out / "PAVS_phenopackets.pb"))
+    else:
+        sources = read_parquet(out / "PAVS_phenopackets.parquet")
+
+    print(f"Validating {len(sources)} PhenoPackets in {out}...")
+    with multiprocessing.Pool(workers) as pool:
+        results = pool.map(_validate_one, sources, chunksize=16)
+
+    invalid = [(pp_id, errors) for pp_id, errors in results if errors]
+    for pp_id, errors in invalid:
+        print(f"Validation errors for {pp_id}: {errors}")
+    print(f"\nValid: {len(results) - len(invalid)} of {len(results)} PhenoPackets")
+    return not invalid
+
+def create_phenopackets(parsed_data_path, output_dir, validate=False, output_format='json'):
+    """
+    Generates PhenoPackets from a structured DataFrame, either as one JSON file per
+    individual ('json') or as a single length-delimited protobuf ('pb') or Parquet file.
+    Inline validation walks every message a second time, so it is off by default
+    for bulk generation; validate the output afterwards in parallel with the
+    'validate' command (validate_output_dir).
     """
     df = pd.read_csv(parsed_data_path).astype(str)
     df.columns = df.columns.str.strip()
 
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
-        print(f"Created output directory: {output_dir}")
+    out = Path(output_dir)
+    out.mkdir(parents=True, exist_ok=True)
+    print(f"Writing PhenoPackets to: {out}")
 
     # --- Create Metadata ---
     # This is a critical step for FAIR compliance. It documents the resources used.
@@ -118,9 +210,10 @@ def create_phenopackets(parsed_data_path, output_dir):
     # We will validate that each phenopacket has at least one HPO term.
     # Set min_hpo=0 to allow generation of phenopackets for individuals with no HPO terms.
     # Set min_disease=0 to allow generation for individuals with no disease annotation.
-    validator = ContentValidator(min_hpo=0)
+    validator = ContentValidator(min_hpo=0) if validate else None
     
     print(f"Generating {len(df)} PhenoPackets...")
+    phenopackets = []
 
     # --- Statistics Collection ---
     stats = {
@@ -144,15 +237,10 @@ def create_phenopackets(parsed_data_path, output_dir):
                 hpo_labels = row['parsed_pheno_text'].split(';')
             
             # If lengths match, we can pair them. Otherwise, we fall back to using IDs as labels.
-            if len(hpo_ids) == len(hpo_labels):
-                for hpo_id, label in zip(hpo_ids, hpo_labels):
-                    term = HpTerm(hpo_id=hpo_id, label=label)
-                    hpo_terms.append(term)
-            else:
-                for hpo_id in hpo_ids:
-                    # Fallback for mismatched labels and IDs from the parser
-                    term = HpTerm(hpo_id=hpo_id, label=hpo_id)
-                    hpo_terms.append(term)
+            if len(hpo_ids) != len(hpo_labels):
+                hpo_labels = []
+            hpo_terms = [HpTerm(hpo_id=hpo_id, label=label or hpo_id)
+                         for hpo_id, label in zip_longest(hpo_ids, hpo_labels)]
 
         if hpo_terms:
             stats["patients_with_phenotypes"] += 1
@@ -182,21 +270,21 @@ def create_phenopackets(parsed_data_path, output_dir):
                 components = parse_variant_components(var_string)
                 
                 # Extract or infer the gene symbol
-                symbol = components['symbol']
-                transcript = components['transcript']
+                symbol = components.symbol
+                transcript = components.transcript
                 
                 # Build the primary HGVS expression
                 # Prefer cDNA if we have transcript, otherwise use genomic or protein
                 hgvs_expr = None
-                if transcript and components['cdna']:
-                    hgvs_expr = f"{transcript}:{components['cdna']}"
-                elif components['genomic']:
-                    hgvs_expr = components['genomic']
-                elif components['cdna']:
-                    hgvs_expr = components['cdna']
-                elif components['protein']:
+                if transcript and components.cdna:
+                    hgvs_expr = f"{transcript}:{components.cdna}"
+                elif components.genomic:
+                    hgvs_expr = components.genomic
+                elif components.cdna:
+                    hgvs_expr = components.cdna
+                elif components.protein:
                     # Protein-only variant
-                    hgvs_expr = components['protein']
+                    hgvs_expr = components.protein
                 else:
                     # Use the original string as fallback
                     hgvs_expr = var_string
@@ -253,27 +341,41 @@ def create_phenopackets(parsed_data_path, output_dir):
             del phenopacket.diseases[:]
 
         # --- 7. Validate and Save ---
-        # It's good practice to validate each phenopacket.
-        # The validator is created once outside the loop.
-        errors = validator.validate_phenopacket(phenopacket)
+        # The validator is created once outside the loop, and only when requested.
+        if validator is not None:
+            errors = validator.validate_phenopacket(phenopacket)
 
-        # The ContentValidator has an undocumented requirement for a disease.
-        # We will filter out this specific error for individuals where we do not expect a disease annotation.
-        if disease_obj is None:
-            errors = [e for e in errors if "disease annotation" not in str(e)]
+            # The ContentValidator has an undocumented requirement for a disease.
+            # We will filter out this specific error for individuals where we do not expect a disease annotation.
+            # Check the message attribute directly rather than formatting the whole result with str().
+            if disease_obj is None:
+                errors = [e for e in errors if "disease annotation" not in e.message]
 
-        if errors:
-            print(f"Validation errors for {individual_id}: {errors}")
-            continue
+            if errors:
+                print(f"Validation errors for {individual_id}: {errors}")
+                continue
 
-        # Save to JSON file
-        json_string = MessageToJson(phenopacket)
-        output_path = os.path.join(output_dir, f"PAVS_{individual_id}.json")
-        with open(output_path, 'w') as f:
-            f.write(json_string)
+        if output_format == 'json':
+            # Save to JSON file
+            json_string = MessageToJson(phenopacket)
+            output_path = out / f"PAVS_{individual_id}.json"
+            with open(output_path, 'w') as f:
+                f.write(json_string)
+        else:
+            # Binary formats are written in one go after the loop
+            phenopackets.append(phenopacket)
         
         stats["generated_phenopackets"] += 1
 
+    if output_format == 'pb':
+        output_path = out / "PAVS_phenopackets.pb"
+        write_length_delimited(phenopackets, output_path)
+        print(f"Saved {len(phenopackets)} PhenoPackets to {output_path}")
+    elif output_format == 'parquet':
+        output_path = out / "PAVS_phenopackets.parquet"
+        write_parquet(phenopackets, output_path)
+        print(f"Saved {len(phenopackets)} PhenoPackets to {output_path}")
+
     # --- Print Summary Statistics ---
     print("\n--- Generation Summary ---")
     print(f"Total individuals processed: {stats['total_patients']}")
@@ -295,11 +397,24 @@ def create_phenopackets(parsed_data_path, output_dir):
         print("\nNo phenotypes were recorded to generate frequency statistics.")
 
 
-if __name__ == '__main__':
-    parser = argparse.ArgumentParser(description="Generate GA4GH Phenopackets from a parsed data file.")
+if __name__ == '__main__' and sys.argv[1:2] == ['validate']:
+    # python phenopacket_generator.py validate <output_dir> [--format ...] [--workers N]
+    parser = argparse.ArgumentParser(prog=f"{os.path.basename(sys.argv[0])} validate", description="Validate the PhenoPackets generated into an output directory with pyphetools.")
+    parser.add_argument('output_dir', help="Output directory passed to the generator.")
+    parser.add_argument('--format', choices=['json', 'pb', 'parquet'], default='json', help="Format the PhenoPackets were written in (default: 'json').")
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help="Number of worker processes (default: number of CPUs).")
+
+    args = parser.parse_args(sys.argv[2:])
+
+    sys.exit(0 if validate_output_dir(args.output_dir, output_format=args.format, workers=args.workers) else 1)
+
+elif __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Generate GA4GH Phenopackets from a parsed data file. Run '%(prog)s validate <output_dir>' to validate the output afterwards.")
     parser.add_argument('parsed_data_path', help="Path to the input CSV file from data_parser.py.")
     parser.add_argument('--output_dir', default='phenopackets', help="Path to the output directory for PhenoPacket JSON files (default: 'phenopackets').")
+    parser.add_argument('--validate', action=argparse.BooleanOptionalAction, default=False, help="Validate each PhenoPacket with pyphetools before saving (default: --no-validate).")
+    parser.add_argument('--format', choices=['json', 'pb', 'parquet'], default='json', help="Output format: one JSON file per individual, a single length-delimited protobuf file, or a single Parquet file (default: 'json').")
     
     args = parser.parse_args()
     
-    create_phenopackets(args.parsed_data_path, args.output_dir)
+    create_phenopackets(args.parsed_data_path, args.output_dir, validate=args.validate, output_format=args.format)
@@ -1,19 +1,124 @@
+import os
+import csv
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from pandas.api.types import union_categoricals
 import subprocess
 import json
 import re
-import warnings
 
-# Hide that specific warning
-warnings.filterwarnings("ignore", category=UserWarning, module="openpyxl")
+HPO_PATTERN = re.compile(r'HP:\d+')
+
+# Version of the processed dataset layout (columns and dtypes) stored in the Parquet caches;
+# bump it whenever a processor changes, so caches written by the old code are rebuilt
+CACHE_VERSION = 2
+CACHE_VERSION_KEY = b'pavs_cache_version'
+
+# Dtypes of the source TSV text columns (named as in the files), applied after reading so
+# pandas does not keep them as object. They are not passed to read_csv: declared dtypes make
+# the pyarrow engine fail on blank cells (e.g. an integer column with gaps under pandas 3).
+# Low-cardinality columns become categoricals in to_categorical, once every source is processed.
+LITERATURE_DTYPES = {
+    'phenotypes': 'string[pyarrow]',
+}
+CLINICAL_LITERATURE_DTYPES = {
+    'Phenotype': 'string[pyarrow]',
+}
+
+# Columns that repeat a handful of values across thousands of records
+LOW_CARDINALITY_COLUMNS = ['test_strategy', 'gender', 'consanguinity', 'zygosity',
+                           'pathogenicity', 'reference', 'dataSourceType']
+
+# Column names aligned with the Phenopackets schema
+COLUMN_NAMES = {
+    'ID': 'ID',
+    'test': 'procedure',
+    'test_strategy': 'procedureStrategy',
+    'gender': 'sex',
+    'age': 'age',
+    'consanguinity': 'consanguinityStatus',
+    'family_id': 'familyId',
+    'number_of_family_members': 'totalFamilyMembers',
+    'cohort_size': 'totalCohortMembers',
+    'phenotypes': 'phenotypicFeatures',
+    'result': 'diagnosis',
+    'result_comment': 'diagnosticComment',
+    'variants': 'genomicVariants',
+    'zygosity': 'zygosityStatus',
+    'pathogenicity': 'variantInterpretation',
+    'HPO_ID': 'phenotypicFeatureIds',
+    'dataSourceType': 'dataSourceType',
+    'reference': 'externalReference',
+}
+
+# Final column order
+FINAL_COLUMNS = [
+    'ID',
+    'sex',
+    'age',
+    'consanguinityStatus',
+    'familyId',
+    'totalFamilyMembers',
+    'totalCohortMembers',
+    'phenotypicFeatures',
+    'phenotypicFeatureIds',
+    'procedure',
+    'procedureStrategy',
+    'diagnosis',
+    'diagnosticComment',
+    'genomicVariants',
+    'zygosityStatus',
+    'variantInterpretation',
+    'dataSourceType',
+    'externalReference'
+]
+
+
+def to_categorical(data):
+    """Store the low-cardinality columns as categoricals with string categories"""
+    def as_category(values):
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            # Assigning strings into a categorical would need them as categories first
+            values = values.cat.rename_categories(str)
+        else:
+            values = values.where(values.isna(), values.astype(str))
+        return values.astype(pd.CategoricalDtype(pd.Index(values.dropna().unique(), dtype=object)))
+    
+    return data.assign(**{col: as_category(data[col]) for col in LOW_CARDINALITY_COLUMNS})
+
+
+def concat_datasets(datasets):
+    """Concatenate processed datasets, unifying categories so categorical columns do not fall back to object"""
+    combined = pd.concat(datasets, ignore_index=True)
+    for col in LOW_CARDINALITY_COLUMNS:
+        combined[col] = union_categoricals([data[col] for data in datasets])
+    return combined
+
+
+def fill_not_reported(data):
+    """Replace missing values with 'Not reported', adding it to the categories where needed"""
+    data = data.assign(**{
+        col: values.cat.add_categories('Not reported')
+        for col, values in data.select_dtypes('category').items()
+        if 'Not reported' not in values.cat.categories
+    })
+    return data.fillna('Not reported')
+
+
+def extract_hpo(phenotypes):
+    """Extract unique HPO IDs from a Series of phenotype text (comma-separated, in order of appearance)"""
+    hits = phenotypes.fillna('').astype(str).str.findall(HPO_PATTERN)
+    return hits.map(lambda ids: ','.join(dict.fromkeys(ids)))
+
 
 def process_literature_data(dataset):
     """Process literature dataset (PAVS & DDIEM)"""
     print("Processing literature data...")
     
     # Load the dataset
-    data = pd.read_csv(dataset, encoding='latin-1', sep='\t')
-    data = data.dropna(how='all')
+    data = pd.read_csv(dataset, encoding='latin-1', sep='\t', engine='pyarrow')
+    data = data.dropna(how='all').astype(LITERATURE_DTYPES)
     
     # Rename columns
     data.rename(columns={
@@ -33,7 +138,7 @@ def process_literature_data(dataset):
     # Add data source type
     data['dataSourceType'] = 'literature'
     # Extract HPO IDs (if any)
-    data['HPO_ID'] = data['phenotypes'].apply(lambda x: ','.join(list(dict.fromkeys(re.findall(r'HP:\d+', x)))))
+    data['HPO_ID'] = extract_hpo(data['phenotypes'])
 
     
     # Select final columns
@@ -42,6 +147,8 @@ def process_literature_data(dataset):
                  'result', 'result_comment', 'variants', 'zygosity', 'pathogenicity', 
                  'reference', 'dataSourceType', 'HPO_ID']]
     
+    data = to_categorical(data)
+    
     print(f"Literature data processed: {data.shape}")
     return data
 
@@ -51,8 +158,8 @@ def process_clinical_literature_data(dataset):
     print("Processing clinical literature data...")
     
     # Load the dataset
-    data = pd.read_csv(dataset, encoding='latin-1', sep='\t')
-    data = data.dropna(how='all')
+    data = pd.read_csv(dataset, encoding='latin-1', sep='\t', engine='pyarrow')
+    data = data.dropna(how='all').astype(CLINICAL_LITERATURE_DTYPES)
     
     
     # Set IDs
@@ -84,7 +191,7 @@ def process_clinical_literature_data(dataset):
     data['cohort_size'] = 'Not reported'
 
     # Extract HPO IDs (if any)
-    data['HPO_ID'] = data['phenotypes'].apply(lambda x: ','.join(list(dict.fromkeys(re.findall(r'HP:\d+', x)))))
+    data['HPO_ID'] = extract_hpo(data['phenotypes'])
     
     # Select final columns
     data = data[['ID', 'test', 'test_strategy', 'gender', 'age', 'consanguinity', 
@@ -92,6 +199,8 @@ def process_clinical_literature_data(dataset):
                  'result', 'result_comment', 'variants', 'zygosity', 'pathogenicity', 
                  'reference', 'dataSourceType','HPO_ID']]
     
+    data = to_categorical(data)
+    
     print(f"Clinical literature data processed: {data.shape}")
     return data
 
@@ -101,7 +210,7 @@ def process_hospital_collaborator_data(dataset):
     print("Processing hospital collaborator data...")
     
     # Load the dataset
-    data = pd.read_excel(dataset, engine="openpyxl")    
+    data = pd.read_excel(dataset, engine="calamine")
 
     # Rename columns
     data = data.rename(columns={
@@ -125,13 +234,11 @@ def process_hospital_collaborator_data(dataset):
     data['pathogenicity'] = data[pathogenicity_columns].fillna('').agg(';'.join, axis=1)
     
     # Combine comment fields
-    data['result_comment'] = data.apply(
-        lambda row: ';'.join([
-            f"Comments: {row['Comments']}" if pd.notna(row['Comments']) else '',
-            f"Inheritance: {row['Inheritance']}" if pd.notna(row['Inheritance']) else '',
-            f"OMIM: {row['Omim']}" if pd.notna(row['Omim']) else ''
-        ]).strip(';'), axis=1
-    )
+    comment_parts = [
+        (f'{label}: ' + data[col].astype(str)).where(data[col].notna(), '')
+        for col, label in [('Comments', 'Comments'), ('Inheritance', 'Inheritance'), ('Omim', 'OMIM')]
+    ]
+    data['result_comment'] = (comment_parts[0] + ';' + comment_parts[1] + ';' + comment_parts[2]).str.strip(';')
     
     # Set metadata fields
     data['reference'] = 'hospital_collaborator, https://link.springer.com/article/10.1186/s12920-020-00743-8 , https://onlinelibrary.wiley.com/doi/full/10.1111/cge.13842'
@@ -140,7 +247,7 @@ def process_hospital_collaborator_data(dataset):
     data['cohort_size'] = data['test_strategy']
     
     # Extract HPO IDs
-    data['HPO_ID'] = data['phenotypes'].apply(lambda x: ','.join(list(dict.fromkeys(re.findall(r'HP:\d+', x)))))
+    data['HPO_ID'] = extract_hpo(data['phenotypes'])
 
     
     # Select final columns
@@ -149,10 +256,39 @@ def process_hospital_collaborator_data(dataset):
                  'result', 'result_comment', 'variants', 'zygosity', 'pathogenicity', 
                  'reference', 'dataSourceType', 'HPO_ID']]
     
+    data = to_categorical(data)
+    
     print(f"Hospital collaborator data processed: {data.shape}")
     
     return data
 
+def load_cached(processor, dataset):
+    """
+    Run processor on dataset, reusing a Parquet cache stored next to the source file.
+    The cache is only used while it is newer than the source and was written by the same
+    processor at the current CACHE_VERSION.
+    """
+    cache = os.path.splitext(dataset)[0] + '.parquet'
+    cache_version = f'{processor.__name__}:{CACHE_VERSION}'.encode()
+    if os.path.exists(cache) and os.path.getmtime(cache) > os.path.getmtime(dataset):
+        metadata = pq.read_schema(cache).metadata or {}
+        if metadata.get(CACHE_VERSION_KEY) == cache_version:
+            print(f"Loading cached dataset: {cache}")
+            # Restore object categories, which pandas 3 reads back as str and union_categoricals rejects
+            return to_categorical(pd.read_parquet(cache))
+        print(f"Cached dataset {cache} was written by a different processor version; rebuilding it.")
+    
+    data = processor(dataset)
+    try:
+        table = pa.Table.from_pandas(data, preserve_index=False)
+        table = table.replace_schema_metadata({**table.schema.metadata, CACHE_VERSION_KEY: cache_version})
+        pq.write_table(table, cache, compression='zstd')
+    except (pa.ArrowInvalid, pa.ArrowTypeError) as e:
+        # Mixed-type object columns cannot be stored as Parquet; just skip caching them
+        print(f"⚠️  Could not cache {dataset} as Parquet: {e}")
+    
+    return data
+
 def create_combined_phenotype_file(data1, data2, output_file='data/id_pheno_combined.tsv'):
     """
     Combine phenotype text from data1 and data2 into one TSV file for HPO annotation.
@@ -160,26 +296,18 @@ def create_combined_phenotype_file(data1, data2, output_file='data/id_pheno_comb
     """
     print("Creating combined phenotype file for annotation...")
     
-    # Extract ID and phenotypes from data1 with prefix
-    pheno1 = data1[['ID', 'phenotypes']].copy()
-    pheno1['ID'] = 'LIT_' + pheno1['ID'].astype(str)
-    pheno1['source'] = 'literature'
-    
-    # Extract ID and phenotypes from data2 with prefix
-    pheno2 = data2[['ID', 'phenotypes']].copy()
-    pheno2['ID'] = 'CLIT_' + pheno2['ID'].astype(str)
-    pheno2['source'] = 'clinical_literature'
-    
-    # Combine both
-    combined = pd.concat([pheno1, pheno2], ignore_index=True)
-    
-    # Save as TSV (only ID and phenotypes columns for the annotation script)
-    combined[['ID', 'phenotypes']].to_csv(output_file, sep='\t', index=False)
+    # Stream the prefixed IDs and phenotypes of both datasets straight to TSV
+    # (only ID and phenotypes columns for the annotation script)
+    with open(output_file, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f, delimiter='\t', lineterminator='\n')
+        writer.writerow(['ID', 'phenotypes'])
+        writer.writerows(zip(('LIT_' + data1['ID'].astype(str)).tolist(), data1['phenotypes'].fillna('').tolist()))
+        writer.writerows(zip(('CLIT_' + data2['ID'].astype(str)).tolist(), data2['phenotypes'].fillna('').tolist()))
     
     print(f"✅ Combined phenotype file saved: {output_file}")
-    print(f"   Total records: {len(combined)}")
-    print(f"   Literature records: {len(pheno1)} (prefixed with LIT_)")
-    print(f"   Clinical literature records: {len(pheno2)} (prefixed with CLIT_)")
+    print(f"   Total records: {len(data1) + len(data2)}")
+    print(f"   Literature records: {len(data1)} (prefixed with LIT_)")
+    print(f"   Clinical literature records: {len(data2)} (prefixed with CLIT_)")
     
     return output_file
 
@@ -200,45 +328,23 @@ def merge_hpo_ids(data, annotation_file, id_prefix):
     with open(annotation_file, 'r') as f:
         annotations = json.load(f)
     
-    # Convert annotations to DataFrame, filtering by prefix
-    hpo_list = []
-    for pid, hpo_terms in annotations.items():
-        if pid.startswith(id_prefix):
-            # Remove prefix to match original IDs
-            original_id = pid.replace(id_prefix, '', 1)
-            hpo_list.append({
-                'ID': original_id,
-                'HPO_ID_annotated': ','.join(hpo_terms)
-            })
-    
-    hpo_df = pd.DataFrame(hpo_list)
+    # Map original IDs (prefix removed) to their annotated HPO IDs, filtering by prefix
+    annotated_ids = {
+        pid[len(id_prefix):]: ','.join(hpo_terms)
+        for pid, hpo_terms in annotations.items()
+        if pid.startswith(id_prefix)
+    }
     
-    # Merge with main data
+    # Look up the annotations of each record
     data['ID'] = data['ID'].astype(str)
-    data = data.merge(hpo_df, on='ID', how='left')
+    annotated = data['ID'].map(annotated_ids).fillna('')
     
-    # Combine and deduplicate HPO IDs
-    def combine_unique_hpo(row):
-        ids = set()
-        
-        # Add regex-extracted HPO IDs (if exist)
-        if pd.notna(row.get('HPO_ID')) and row['HPO_ID']:
-            ids.update([x.strip() for x in str(row['HPO_ID']).split(',') if x.strip()])
-        
-        # Add annotated HPO IDs
-        if pd.notna(row.get('HPO_ID_annotated')) and row['HPO_ID_annotated']:
-            ids.update([x.strip() for x in row['HPO_ID_annotated'].split(',') if x.strip()])
-        
-        # Remove empty strings and invalid IDs
-        ids = {x for x in ids if x and x.startswith('HP:')}
-        
-        return ','.join(sorted(ids)) if ids else ''
-    
-    data['HPO_ID'] = data.apply(combine_unique_hpo, axis=1)
-    
-    # Drop temporary column
-    if 'HPO_ID_annotated' in data.columns:
-        data = data.drop(columns=['HPO_ID_annotated'])
+    # Combine regex-extracted and annotated HPO IDs, keeping sorted unique valid IDs per record
+    combined = data['HPO_ID'].fillna('').astype(str) + ',' + annotated
+    ids = combined.str.split(',').explode().str.strip()
+    ids = ids[ids.str.startswith('HP:', na=False)]
+    ids = ids.rename('hpo').rename_axis('row').reset_index().drop_duplicates().sort_values(['row', 'hpo'])
+    data['HPO_ID'] = ids.groupby('row')['hpo'].agg(','.join).reindex(data.index, fill_value='')
     
     print(f"✅ HPO IDs merged and deduplicated for {id_prefix} records")
     
@@ -274,12 +380,9 @@ def annotate_and_merge_hpo(data1, data2, data3):
     print("HPO Annotation Workflow")
     print("=" * 60)
     
-    # Step 1: Extract HPO IDs from existing text (regex)
-    print("\nStep 1: Extracting HPO IDs from text using regex...")
+    # Step 1: Report HPO IDs already extracted from the text (regex) by the process_*_data functions
+    print("\nStep 1: HPO IDs extracted from text using regex...")
     for data, name in [(data1, 'data1'), (data2, 'data2'), (data3, 'data3')]:
-        data['HPO_ID'] = data['phenotypes'].apply(
-            lambda x: ','.join(list(dict.fromkeys(re.findall(r'HP:\d+', x)))) if pd.notna(x) else ''
-        )
         existing_count = (data['HPO_ID'] != '').sum()
         print(f"   {name}: {existing_count} records with existing HPO IDs")
     
@@ -329,9 +432,9 @@ def main():
     print("=" * 60)
     
     # Process each dataset
-    data1 = process_literature_data("../data/PAVS_DDIEM_lit.tsv")
-    data2 = process_clinical_literature_data("../data/439_2017_1821_MOESM1_ESM.txt")
-    data3 = process_hospital_collaborator_data("../data/Variant_list_National_guards_transcripts.xlsx")
+    data1 = load_cached(process_literature_data, "../data/PAVS_DDIEM_lit.tsv")
+    data2 = load_cached(process_clinical_literature_data, "../data/439_2017_1821_MOESM1_ESM.txt")
+    data3 = load_cached(process_hospital_collaborator_data, "../data/Variant_list_National_guards_transcripts.xlsx")
     
     # Annotate and merge HPO terms (combines regex + NLP annotation)
     data1, data2, data3 = annotate_and_merge_hpo(data1, data2, data3)
@@ -345,62 +448,15 @@ def main():
     print(f'Clinical literature size: {data2.shape}')
     print(f'Clinical collaborator size: {data3.shape}')
     
-    # Combine all datasets
-    final_data = pd.concat([data1, data2, data3], ignore_index=True)
+    # Replace NaN values in each dataset, then combine them
+    final_data = concat_datasets([fill_not_reported(data) for data in (data1, data2, data3)])
     print(f'Total combined: {final_data.shape}')
     
     # Generate new IDs
-    final_data['ID'] = ['PAVS' + str(i+1) for i in range(len(final_data))]
-    final_data = final_data.drop_duplicates()
-    
-    # Rename columns to align with Phenopackets schema
-    new_column_names = {
-        'ID': 'ID',
-        'test': 'procedure',
-        'test_strategy': 'procedureStrategy',
-        'gender': 'sex',
-        'age': 'age',  
-        'consanguinity': 'consanguinityStatus',
-        'family_id': 'familyId',
-        'number_of_family_members': 'totalFamilyMembers',
-        'cohort_size': 'totalCohortMembers',
-        'phenotypes': 'phenotypicFeatures',
-        'result': 'diagnosis',
-        'result_comment': 'diagnosticComment',
-        'variants': 'genomicVariants',
-        'zygosity': 'zygosityStatus',
-        'pathogenicity': 'variantInterpretation',
-        'HPO_ID': 'phenotypicFeatureIds',
-        'dataSourceType': 'dataSourceType',
-        'reference': 'externalReference',
-    }
+    final_data['ID'] = 'PAVS' + pd.RangeIndex(1, len(final_data) + 1).astype(str)
     
-    final_data.rename(columns=new_column_names, inplace=True)
-    
-    # Organize columns in logical order
-    final_data = final_data[[
-        'ID',
-        'sex',
-        'age',
-        'consanguinityStatus',
-        'familyId',
-        'totalFamilyMembers',
-        'totalCohortMembers',
-        'phenotypicFeatures',
-        'phenotypicFeatureIds',
-        'procedure',
-        'procedureStrategy',
-        'diagnosis',
-        'diagnosticComment',
-        'genomicVariants',
-        'zygosityStatus',
-        'variantInterpretation',
-        'dataSourceType',
-        'externalReference'
-    ]]
-    
-    # Replace NaN values
-    final_data = final_data.fillna('Not reported')
+    # Rename columns to align with Phenopackets schema and organize them in logical order
+    final_data = final_data.rename(columns=COLUMN_NAMES).reindex(columns=FINAL_COLUMNS)
     
     print("\n" + "=" * 60)
     print("Saving final dataset")
@@ -412,8 +468,12 @@ def main():
     
     #final_data = final_data[final_data['phenotypicFeatureIds'] != 'Not reported']
     
-    # Save final data
+    # Save final data. pandas only quotes the fields that need it; pyarrow's CSV
+    # writer would quote every string and change the TSV format
     final_data.to_csv('PAVS_final_data.tsv', sep='\t', index=False)
+    # Columnar copy for downstream consumers; values are stringified as in the TSV
+    final_table = pa.Table.from_pandas(final_data.astype(str), preserve_index=False)
+    pq.write_table(final_table, 'PAVS_final_data.parquet', compression='zstd')
     
     print(f'Final data saved: {final_data.shape}')
     print("\n" + "=" * 60)
@@ -1,42 +1,318 @@
 # Import necessary libraries
 import os
 import json
+import hashlib
+import orjson
+import pickle
 import argparse
 import logging
+import multiprocessing
+from collections import OrderedDict
+from functools import lru_cache
+from dataclasses import dataclass, replace
+from itertools import chain
+import numpy as np
 import pandas as pd
-from tqdm import tqdm
+from tqdm.auto import tqdm
 from tqdm.contrib.logging import logging_redirect_tqdm
+import pyhpo
 from pyhpo import Ontology, HPOSet
-from sklearn.metrics import roc_auc_score
 import hgvs.parser
 import hgvs.dataproviders.uta
 import hgvs.assemblymapper
 import hgvs.exceptions
 
+try:
+    from numba import njit
+except ImportError:  # numba is optional; best_match_average falls back to NumPy
+    njit = None
 
-def load_gene_hpo_profiles():
+
+def load_gene_hpo_profiles(term_tables):
     """
-    Initializes the HPO Ontology and creates a mapping from gene symbols to their
-    associated HPO term sets.
+    Creates the gene-to-phenotype profiles: the indices in term_tables of the HPO
+    terms associated with each gene symbol, packed into PackedProfiles.
     """
-    logging.info("Initializing HPO Ontology... (This may download files on first run)")
-    _ = Ontology()
-    logging.info("Ontology initialized successfully.")
+    # Resolve pyhpo's integer term IDs once instead of looking every annotation up in the Ontology
+    int_to_index = {int(term): term_tables.term_index[term.id] for term in Ontology}
     
-    gene_profiles = {}
+    gene_terms = {}
     logging.info("Building gene-to-phenotype profiles...")
     for gene in tqdm(Ontology.genes, desc="Processing Genes"):
         if not gene.hpo:
             continue
         
-        # Convert integer HPO IDs from the gene object to HP:XXXXXXX string format
-        hpo_ids_as_str = [Ontology[hpo_id].id for hpo_id in gene.hpo]
+        # Convert integer HPO IDs from the gene object to term indices
+        gene_terms[gene.name] = [int_to_index[hpo_id] for hpo_id in gene.hpo]
+        
+    logging.info(f"Built profiles for {len(gene_terms)} genes with phenotype associations.")
+    return pack_profiles(gene_terms)
+
+
+def load_omim_profiles(term_tables):
+    """
+    Creates the disease-to-phenotype profiles: the indices in term_tables of the HPO
+    terms annotated to each OMIM disease (keyed as OMIM:XXXXXX), packed into PackedProfiles.
+    """
+    int_to_index = {int(term): term_tables.term_index[term.id] for term in Ontology}
+    
+    disease_terms = {}
+    logging.info("Building disease-to-phenotype profiles...")
+    for disease in tqdm(Ontology.omim_diseases, desc="Processing Diseases"):
+        if not disease.hpo:
+            continue
+        disease_terms[f"OMIM:{disease.id}"] = [int_to_index[hpo_id] for hpo_id in disease.hpo]
         
-        # Create an HPOSet for similarity calculations
-        gene_profiles[gene.name] = HPOSet.from_queries(hpo_ids_as_str)
+    logging.info(f"Built profiles for {len(disease_terms)} OMIM diseases with phenotype associations.")
+    return pack_profiles(disease_terms)
+
+
+# Profile builder for each ranking target
+PROFILE_LOADERS = {
+    'genes': load_gene_hpo_profiles,
+    'diseases': load_omim_profiles,
+}
+
+@dataclass
+class TermTables:
+    """Integer-indexed HPO term data used for vectorized similarity scoring."""
+    term_index: dict                # HPO ID (HP:XXXXXXX) -> row index
+    ic: np.ndarray                  # Information content (OMIM) of each term
+    ancestors: np.ndarray           # Ancestors of every term, including the term itself, concatenated
+    ancestor_offsets: np.ndarray    # Term i owns ancestors[ancestor_offsets[i]:ancestor_offsets[i + 1]]
+    shallow_terms: np.ndarray       # Root terms and their children (e.g., Phenotypic abnormality)
+    shallow: np.ndarray             # shallow[i, k]: shallow_terms[k] is an ancestor of term i
+    categories: np.ndarray          # categories[i, c]: term i lies under top-level category c (e.g., an organ system)
+
+
+def _ancestor_membership(ancestor_lists, ancestors, members):
+    """Boolean matrix of which of the member terms are ancestors of each term."""
+    position = np.full(len(ancestor_lists), -1, dtype=np.int64)
+    position[members] = np.arange(len(members))
+    owners = np.repeat(np.arange(len(ancestor_lists)), [len(a) for a in ancestor_lists])
+    hits = position[ancestors] >= 0
+    membership = np.zeros((len(ancestor_lists), len(members)), dtype=bool)
+    membership[owners[hits], position[ancestors[hits]]] = True
+    return membership
+
+
+def build_term_tables():
+    """
+    Assigns every HPO term an integer index and precomputes its information content
+    and ancestor closure once, so that finding the most informative common ancestor
+    (MICA) of two terms becomes an array reduction instead of an ontology walk.
+    """
+    logging.info("Precomputing HPO term information content and ancestors...")
+    terms = list(Ontology)
+    term_index = {term.id: i for i, term in enumerate(terms)}
+    ic = np.fromiter((term.information_content.omim for term in terms), dtype=np.float64, count=len(terms))
+    
+    ancestor_lists = [[i] + [term_index[parent.id] for parent in term.all_parents] for i, term in enumerate(terms)]
+    ancestor_offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+    np.cumsum([len(a) for a in ancestor_lists], out=ancestor_offsets[1:])
+    ancestors = np.fromiter(chain.from_iterable(ancestor_lists), dtype=np.int32, count=ancestor_offsets[-1])
+    
+    # Any common ancestor of two terms that share no top-level category is a shallow term
+    shallow = {t for root in terms if not root.parents for t in [root, *root.children]}
+    categories = {child for t in shallow for child in t.children} - shallow
+    shallow_terms = np.array(sorted(term_index[t.id] for t in shallow), dtype=np.int64)
+    category_terms = np.array(sorted(term_index[t.id] for t in categories), dtype=np.int64)
+    
+    return TermTables(
+        term_index=term_index, ic=ic, ancestors=ancestors, ancestor_offsets=ancestor_offsets,
+        shallow_terms=shallow_terms,
+        shallow=_ancestor_membership(ancestor_lists, ancestors, shallow_terms),
+        categories=_ancestor_membership(ancestor_lists, ancestors, category_terms),
+    )
+
+
+@dataclass
+class PackedProfiles:
+    """Entity profiles packed end to end, so every entity can be scored with one reduction."""
+    entity_ids: np.ndarray      # Entity IDs (e.g., gene symbols), in profile order
+    entity_index: dict          # Entity ID -> position in entity_ids
+    terms: np.ndarray           # Term indices of every profile, concatenated
+    offsets: np.ndarray         # Entity i owns terms[offsets[i]:offsets[i + 1]]
+
+
+def pack_profiles(entity_terms):
+    """
+    Packs a mapping of entity IDs to non-empty lists of term indices into PackedProfiles.
+    """
+    offsets = np.zeros(len(entity_terms) + 1, dtype=np.int64)
+    np.cumsum([len(terms) for terms in entity_terms.values()], out=offsets[1:])
+    terms = np.fromiter(chain.from_iterable(entity_terms.values()), dtype=np.int32, count=offsets[-1])
+    entity_ids = np.fromiter(entity_terms.keys(), dtype=object, count=len(entity_terms))
+    entity_index = {entity_id: i for i, entity_id in enumerate(entity_terms)}
+    return PackedProfiles(entity_ids=entity_ids, entity_index=entity_index, terms=terms, offsets=offsets)
+
+
+def term_similarity_rows(patient_idx, term_tables, similarity_method='resnik'):
+    """
+    Calculates the similarity of each patient term to every HPO term.
+    
+    Args:
+        patient_idx (numpy.ndarray): Term indices of the patient's HPO terms.
+        term_tables (TermTables): Precomputed term information content and ancestors.
+        similarity_method (str): The similarity algorithm to use ('resnik', 'lin', 'jc', 'rel').
         
-    logging.info(f"Built profiles for {len(gene_profiles)} genes with phenotype associations.")
-    return gene_profiles
+    Returns:
+        numpy.ndarray: A (len(patient_idx), number of terms) matrix of term similarities.
+    """
+    mica = term_mica_rows(patient_idx, term_tables)
+    all_terms = np.arange(len(term_tables.ic))
+    return similarity_from_mica(mica, patient_idx, all_terms, term_tables.ic, similarity_method)
+
+
+def term_mica_rows(patient_idx, term_tables):
+    """
+    Calculates the information content of the most informative common ancestor
+    (MICA) of each patient term and every HPO term.
+    """
+    ic = term_tables.ic
+    offsets = term_tables.ancestor_offsets
+    starts = offsets[:-1]
+    ancestor_counts = np.diff(offsets)
+    mica = np.empty((len(patient_idx), len(ic)), dtype=np.float64)
+    shared_ic = np.zeros(len(ic), dtype=np.float64)
+    for row, p in enumerate(patient_idx):
+        patient_ancestors = term_tables.ancestors[starts[p]:offsets[p + 1]]
+        # IC of the patient term's ancestors, zero elsewhere; the max over another
+        # term's ancestors is then the IC of their most informative common ancestor
+        shared_ic[patient_ancestors] = ic[patient_ancestors]
+        # Terms outside the patient term's top-level categories can only share shallow ancestors
+        mica[row] = (term_tables.shallow * shared_ic[term_tables.shallow_terms]).max(axis=1)
+        # Walk the full ancestor closure only for terms in one of those categories
+        candidates = np.flatnonzero(term_tables.categories[:, term_tables.categories[p]].any(axis=1))
+        if len(candidates):
+            lengths = ancestor_counts[candidates]
+            candidate_starts = np.zeros(len(candidates), dtype=np.int64)
+            np.cumsum(lengths[:-1], out=candidate_starts[1:])
+            gather = np.repeat(starts[candidates] - candidate_starts, lengths) + np.arange(candidate_starts[-1] + lengths[-1])
+            mica[row, candidates] = np.maximum.reduceat(shared_ic[term_tables.ancestors[gather]], candidate_starts)
+        shared_ic[patient_ancestors] = 0.0
+    return mica
+
+
+def similarity_from_mica(mica, rows, columns, ic, similarity_method='resnik'):
+    """
+    Derives term similarities from a matrix of MICA information content between the
+    term indices along its rows and columns, given the information content of every term.
+    """
+    if similarity_method == 'resnik':
+        return mica
+    
+    row_ic = ic[rows]
+    column_ic = ic[columns]
+    ic_sum = row_ic[:, None] + column_ic[None, :]
+    if similarity_method == 'jc':
+        # As pyhpo: unannotated terms score 0 and a term is fully similar to itself
+        jc = 1.0 / (ic_sum - 2 * mica + 1)
+        jc[(row_ic == 0)[:, None] | (column_ic == 0)[None, :]] = 0.0
+        jc[np.asarray(rows)[:, None] == np.asarray(columns)[None, :]] = 1.0
+        return jc
+    
+    lin = np.divide(2 * mica, ic_sum, out=np.zeros_like(mica), where=ic_sum > 0)
+    if similarity_method == 'lin':
+        return lin
+    if similarity_method == 'rel':
+        return lin * (1 - np.exp(-mica))
+    raise ValueError(f"Unsupported similarity method: {similarity_method}")
+
+
+def mica_columns_path(path):
+    """Path of the file holding the column term indices of the MICA matrix saved at path."""
+    return os.path.splitext(path)[0] + '_columns.npy'
+
+
+def ensure_mica_matrix(path, term_tables, columns, chunk_size=256):
+    """
+    Makes sure path holds the MICA information content of every HPO term (rows)
+    against the given term indices (columns), e.g. the terms used by gene profiles.
+    The matrix is computed once and saved as a .npy file, and is rebuilt only when
+    it was saved for different terms. Rows are written straight to a memory-mapped
+    file, so the full matrix never has to fit in memory.
+    """
+    columns_path = mica_columns_path(path)
+    shape = (len(term_tables.ic), len(columns))
+    if os.path.exists(path) and os.path.exists(columns_path):
+        if np.load(path, mmap_mode='r').shape == shape and np.array_equal(np.load(columns_path), columns):
+            logging.info(f"Using precomputed MICA matrix {path}")
+            return
+        logging.info(f"MICA matrix {path} was built for different terms; rebuilding it.")
+
+    mica = np.lib.format.open_memmap(path, mode='w+', dtype=np.float32, shape=shape)
+    for start in tqdm(range(0, shape[0], chunk_size), desc="Computing MICA matrix"):
+        rows = np.arange(start, min(start + chunk_size, shape[0]), dtype=np.int32)
+        mica[start:start + len(rows)] = term_mica_rows(rows, term_tables)[:, columns]
+    mica.flush()
+    del mica
+    np.save(columns_path, columns)
+
+
+def load_mica_matrix(path):
+    """Memory-maps a MICA matrix saved by ensure_mica_matrix, returning it with its column term indices."""
+    return np.load(path, mmap_mode='r'), np.load(mica_columns_path(path))
+
+
+# Bumped whenever TermTables, PackedProfiles or their construction changes, so older caches are rebuilt
+CACHE_FORMAT = 1
+
+
+def ontology_release():
+    """
+    Identifies the loaded HPO release and annotations: a digest of Ontology.version() where
+    pyhpo provides it (hpo3), every term with its parents and OMIM information content, and
+    the terms annotated to every gene and OMIM disease. Annotation files can change without
+    changing the term IDs or annotation counts, so those alone cannot tell releases apart.
+    """
+    digest = hashlib.sha256()
+    version = getattr(Ontology, 'version', None)
+    if callable(version):
+        digest.update(f"version:{version()}\n".encode())
+    for term in sorted(Ontology, key=lambda t: t.id):
+        parents = ','.join(sorted(parent.id for parent in term.parents))
+        digest.update(f"{term.id}:{parents}:{term.information_content.omim!r}\n".encode())
+    for kind, entities in (('gene', Ontology.genes), ('omim', Ontology.omim_diseases)):
+        for key, hpo in sorted((str(entity.id), sorted(entity.hpo)) for entity in entities):
+            digest.update(f"{kind}:{key}:{hpo}\n".encode())
+    return digest.hexdigest()
+
+
+def load_term_tables_and_profiles(target='genes', cache_path=None):
+    """
+    Initializes the HPO Ontology and builds the term tables and the profiles of the
+    target entities ('genes' or 'diseases'), or loads them from cache_path when it was
+    written for the same target, HPO release and annotations, and pyhpo version. A rebuilt result is
+    written back to cache_path.
+    
+    Returns:
+        tuple: The TermTables and the target PackedProfiles.
+    """
+    logging.info("Initializing HPO Ontology... (This may download files on first run)")
+    _ = Ontology()
+    logging.info("Ontology initialized successfully.")
+    
+    version_key = (CACHE_FORMAT, pyhpo.__version__, ontology_release(), target)
+    if cache_path and os.path.exists(cache_path):
+        try:
+            with open(cache_path, 'rb') as f:
+                cached_version, term_tables, profiles = pickle.load(f)
+            if cached_version == version_key:
+                logging.info(f"Loaded term tables and {target} profiles from {cache_path}")
+                return term_tables, profiles
+            logging.info(f"{cache_path} was built for a different target or HPO release; rebuilding it.")
+        except Exception as e:
+            # Unpickling can fail in many ways (e.g., AttributeError, ModuleNotFoundError) for a stale cache
+            logging.warning(f"Could not read {cache_path}, rebuilding it: {e}")
+    
+    term_tables = build_term_tables()
+    profiles = PROFILE_LOADERS[target](term_tables)
+    if cache_path:
+        with open(cache_path, 'wb') as f:
+            pickle.dump((version_key, term_tables, profiles), f, protocol=5)
+    return term_tables, profiles
+
 
 def initialize_hgvs_mapper():
     """
@@ -57,144 +333,441 @@ def initialize_hgvs_mapper():
         return None
 
 
-def calculate_similarity_ranking(patient_hpo_set, entity_profiles, similarity_method='resnik'):
+def score_entities(patient_idx, entity_profiles, term_tables, similarity_method='resnik'):
     """
-    Calculates the similarity between a patient's HPOSet and all entity profiles (e.g., genes),
-    returning a ranked list of entities.
+    Calculates the similarity between a patient's HPO terms and every entity profile (e.g., genes).
+    Set similarity is the funSimAvg of the term similarities, as in pyhpo's HPOSet.similarity.
     
     Args:
-        patient_hpo_set (HPOSet): The set of HPO terms for the patient.
-        entity_profiles (dict): A dictionary of entity IDs (e.g., gene symbols) to HPOSets.
+        patient_idx (numpy.ndarray): Distinct term indices of the patient's HPO terms.
+        entity_profiles (PackedProfiles): The term indices of every entity (e.g., gene) profile.
+        term_tables (TermTables): Precomputed term information content and ancestors.
         similarity_method (str): The similarity algorithm to use ('resnik', 'lin', 'jc', 'rel').
         
     Returns:
-        pandas.DataFrame: A DataFrame with entity IDs and their similarity scores,
-                          sorted in descending order.
+        numpy.ndarray: The similarity score of each entity, in the order of entity_profiles.
     """
-    if not patient_hpo_set:
-        return pd.DataFrame(columns=['entity_id', 'similarity_score'])
+    term_sims = term_similarity_rows(patient_idx, term_tables, similarity_method)
+    return best_match_average(term_sims, entity_profiles)
+
+
+def check_pyhpo_parity(term_tables, entity_profiles, n_patients=5, n_entities=20, seed=0, tolerance=1e-6):
+    """
+    Checks that score_entities reproduces pyhpo's HPOSet.similarity (OMIM information
+    content, funSimAvg) for every supported similarity method, scoring random patients
+    drawn from the profiles against a random sample of the entity profiles.
+    
+    Raises:
+        AssertionError: If any score differs from pyhpo's by more than tolerance.
+    """
+    rng = np.random.default_rng(seed)
+    term_ids = np.empty(len(term_tables.ic), dtype=object)
+    for hpo_id, i in term_tables.term_index.items():
+        term_ids[i] = hpo_id
+    
+    offsets = entity_profiles.offsets
+    entities = rng.choice(len(offsets) - 1, size=min(n_entities, len(offsets) - 1), replace=False)
+    sample = pack_profiles({
+        entity_profiles.entity_ids[e]: entity_profiles.terms[offsets[e]:offsets[e + 1]] for e in entities
+    })
+    entity_sets = [
+        HPOSet.from_queries(term_ids[sample.terms[start:end]].tolist())
+        for start, end in zip(sample.offsets[:-1], sample.offsets[1:])
+    ]
+    
+    for _ in range(n_patients):
+        # Part of one sampled profile, so identical terms are compared, plus random terms
+        e = rng.integers(len(entity_sets))
+        own_terms = sample.terms[sample.offsets[e]:sample.offsets[e + 1]]
+        patient_idx = np.unique(np.concatenate([
+            rng.choice(own_terms, size=min(3, len(own_terms)), replace=False),
+            rng.integers(len(term_ids), size=2),
+        ])).astype(np.int32)
+        patient_set = HPOSet.from_queries(term_ids[patient_idx].tolist())
         
-    results = []
-    for entity_id, entity_hpo_set in entity_profiles.items():
-        score = patient_hpo_set.similarity(entity_hpo_set, method=similarity_method)
-        results.append({'entity_id': entity_id, 'similarity_score': score})
+        for method in ('resnik', 'lin', 'jc', 'rel'):
+            scores = score_entities(patient_idx, sample, term_tables, method)
+            expected = np.array([patient_set.similarity(s, kind='omim', method=method) for s in entity_sets])
+            difference = np.abs(scores - expected).max()
+            # Raised explicitly rather than asserted, so the check still runs under python -O
+            if not difference <= tolerance:
+                raise AssertionError(
+                    f"{method} scores differ from pyhpo by up to {difference:.3g} "
+                    f"for patient terms {term_ids[patient_idx].tolist()}"
+                )
+    logging.info("Similarity scores match pyhpo for resnik, lin, jc and rel.")
+
+
+if njit is not None:
+    @njit(cache=True, nogil=True)
+    def _best_match_average_kernel(term_sims, terms, offsets, out):
+        """Compiled funSimAvg of each profile, reading term_sims in place instead of gathering it."""
+        n_patient_terms = term_sims.shape[0]
+        for e in range(len(offsets) - 1):
+            start, end = offsets[e], offsets[e + 1]
+            patient_total = 0.0
+            for p in range(n_patient_terms):
+                best = -np.inf
+                for j in range(start, end):
+                    best = max(best, term_sims[p, terms[j]])
+                patient_total += best
+            entity_total = 0.0
+            for j in range(start, end):
+                best = -np.inf
+                for p in range(n_patient_terms):
+                    best = max(best, term_sims[p, terms[j]])
+                entity_total += best
+            out[e] = (patient_total / n_patient_terms + entity_total / (end - start)) / 2
+else:
+    _best_match_average_kernel = None
+
+
+def best_match_average(term_sims, entity_profiles):
+    """
+    Reduces the similarities of the patient terms to every HPO term (rows of
+    term_similarity_rows) to the funSimAvg score of each entity profile.
+    """
+    if _best_match_average_kernel is not None:
+        scores = np.empty(len(entity_profiles.offsets) - 1, dtype=np.float64)
+        _best_match_average_kernel(np.ascontiguousarray(term_sims), entity_profiles.terms, entity_profiles.offsets, scores)
+        return scores
+    
+    # Similarity of each patient term to each term of every profile, profiles side by side
+    pair_sims = term_sims[:, entity_profiles.terms]
+    starts = entity_profiles.offsets[:-1]
+    # Best match of each patient term within each profile, averaged over the patient terms
+    patient_side = np.maximum.reduceat(pair_sims, starts, axis=1).mean(axis=0)
+    # Best match of each profile term among the patient terms, averaged within each profile
+    entity_side = np.add.reduceat(pair_sims.max(axis=0), starts) / np.diff(entity_profiles.offsets)
+    
+    return (patient_side + entity_side) / 2
+
+def rank_and_roc_auc(scores, index):
+    """
+    Evaluates scores[index] as the only positive, from one pass of each comparison.
+    
+    Returns:
+        tuple: The 1-based rank of scores[index] in a stable descending sort of scores
+               (entities scoring higher, plus ties listed earlier, rank ahead of it), and
+               the ROC AUC: the fraction of negatives scoring below it, counting ties as
+               half (as roc_auc_score does). The ROC AUC is NaN if there are no negatives.
+    """
+    score = scores[index]
+    higher = np.count_nonzero(scores > score)
+    tied = scores == score
+    rank = int(higher + np.count_nonzero(tied[:index])) + 1
+    negatives = len(scores) - 1
+    if not negatives:
+        return rank, float('nan')
+    return rank, (negatives - higher - 0.5 * (np.count_nonzero(tied) - 1)) / negatives
+
+def top_k(scores, k=10):
+    """Returns the indices of the k highest scores in descending order, using a partial sort."""
+    k = min(k, len(scores))
+    if k < len(scores):
+        top = np.argpartition(-scores, k)[:k]
+    else:
+        top = np.arange(len(scores))
+    return top[np.argsort(-scores[top], kind='stable')]
+
+
+@lru_cache(maxsize=512)
+def _cached_term_similarity_row(term_idx, similarity_method):
+    """
+    Similarity of one HPO term to every term, or to the MICA matrix columns when one
+    is loaded, reused across patients sharing the term.
+    """
+    term_tables = _worker_state['term_tables']
+    mica = _worker_state.get('mica')
+    if mica is None:
+        row = term_similarity_rows(np.array([term_idx], dtype=np.int32), term_tables, similarity_method)[0]
+    else:
+        columns = _worker_state['mica_columns']
+        mica_row = np.asarray(mica[term_idx:term_idx + 1], dtype=np.float64)
+        row = similarity_from_mica(mica_row, [term_idx], columns, term_tables.ic, similarity_method)[0]
+    row.setflags(write=False)
+    return row
+
+
+def _score_patient_terms(patient_idx, similarity_method):
+    """Scores every profile in _worker_state against an array of distinct patient term indices."""
+    term_sims = np.stack([_cached_term_similarity_row(int(t), similarity_method) for t in patient_idx])
+    scores = best_match_average(term_sims, _worker_state['profiles'])
+    scores.setflags(write=False)
+    return scores
+
+
+# Profile scores of recently seen patients, keyed by (similarity method, frozenset of
+# HPO IDs), so phenopackets sharing a phenotype profile are only scored once
+_ranking_cache = OrderedDict()
+RANKING_CACHE_SIZE = 512
+
+
+# State read by score_phenopacket; filled in by run_validation before the worker
+# processes start, so forked workers share the profiles and term tables copy-on-write.
+_worker_state = {}
+
+
+def _init_worker(state, use_hgvs_mapper):
+    """
+    Prepares a worker process. Spawned workers start from a fresh interpreter, so
+    they install the pickled state; forked workers already inherit it. Either way
+    a new UTA connection is opened, since a database connection cannot be shared
+    safely by several processes.
+    """
+    if not _worker_state:
+        _worker_state.update(state, hgvs_parser=hgvs.parser.Parser())
+        if state['mica_cache']:
+            _worker_state['mica'], _ = load_mica_matrix(state['mica_cache'])
+    if use_hgvs_mapper:
+        _worker_state['hgvs_mapper'] = initialize_hgvs_mapper()
+
+
+def extract_ground_truth_gene(data, hgvs_mapper, hgvs_parser):
+    """
+    Returns the causal gene symbol of a PhenoPacket from its first interpretation's
+    geneContext, falling back to mapping its HGVS expression, or None if neither is available.
+    """
+    ground_truth_gene = None
+    interpretations = data.get('interpretations', [])
+    if interpretations:
+        # Path: Interpretation -> diagnosis -> genomicInterpretations -> variantInterpretation -> variationDescriptor -> geneContext
+        try:
+            gene_context = interpretations[0]['diagnosis']['genomicInterpretations'][0]['variantInterpretation']['variationDescriptor']['geneContext']
+            ground_truth_gene = gene_context.get('symbol')
+        except (KeyError, IndexError):
+            pass  # No geneContext found, will try HGVS parsing next.
+
+        # Fallback: If no geneContext, try parsing HGVS expression from transcript ID
+        if ground_truth_gene is None and hgvs_mapper:
+            try:
+                var_descriptor = interpretations[0]['diagnosis']['genomicInterpretations'][0]['variantInterpretation']['variationDescriptor']
+                expressions = var_descriptor.get('expressions', [])
+                if expressions:
+                    # Use the first available HGVS string
+                    hgvs_string = expressions[0].get('value')
+                    if hgvs_string:
+                        try:
+                            variant = hgvs_parser.parse(hgvs_string)
+                            transcript_id = variant.ac
+                            try:
+                                # Use the data provider (hdp) associated with the mapper to get transcript identity info
+                                tx_identity_info = hgvs_mapper.hdp.get_tx_identity_info(transcript_id)
+                                # The hgnc gene symbol is at index 2 of the returned tuple.
+                                if tx_identity_info and len(tx_identity_info) > 2 and tx_identity_info[2]:
+                                    ground_truth_gene = tx_identity_info[2]
+
+                                if ground_truth_gene:
+                                    logging.debug(f"Mapped transcript '{transcript_id}' to gene '{ground_truth_gene}' for {data['id']}.")
+                            except hgvs.exceptions.HGVSDataNotAvailableError as e:
+                                logging.warning(f"Could not map transcript '{transcript_id}' in {data['id']}: {e}")
+                        except hgvs.exceptions.HGVSParseError as e:
+                            logging.warning(f"Could not parse HGVS string '{hgvs_string}' in {data['id']}: {e}")
+            except (KeyError, IndexError):
+                pass # Path to expressions not found
+
+    return ground_truth_gene
+
+
+def extract_ground_truth_disease(data):
+    """
+    Returns the diagnosed disease ID (e.g., OMIM:123456) of a PhenoPacket from its first
+    disease, falling back to its first interpretation's diagnosis, or None if neither is available.
+    """
+    try:
+        return data['diseases'][0]['term']['id']
+    except (KeyError, IndexError):
+        pass
+    try:
+        return data['interpretations'][0]['diagnosis']['disease']['id']
+    except (KeyError, IndexError):
+        return None
+
+
+def load_phenopacket_json(raw):
+    """
+    Parses PhenoPacket JSON with orjson, falling back to the json module for the
+    non-standard NaN/Infinity constants that json.dump writes for missing values.
+    """
+    try:
+        return orjson.loads(raw)
+    except orjson.JSONDecodeError:
+        return json.loads(raw)
+
+
+def score_phenopacket(source):
+    """
+    Performs similarity analysis of a single PhenoPacket against the gene or disease
+    profiles in _worker_state and evaluates the ranking of its true causal gene or diagnosis.
+    
+    Args:
+        source (str or bytes): Path to the PhenoPacket JSON file, or the PhenoPacket's
+                               JSON itself (a line of an NDJSON corpus).
         
-    ranked_df = pd.DataFrame(results)
-    ranked_df = ranked_df.sort_values(by='similarity_score', ascending=False).reset_index(drop=True)
+    Returns:
+        dict: The validation result for the PhenoPacket, or None if it was skipped.
+    """
+    profiles = _worker_state['profiles']
+    target = _worker_state['target']
+    term_tables = _worker_state['term_tables']
+    similarity_method = _worker_state['similarity_method']
+    hgvs_mapper = _worker_state['hgvs_mapper']
+    hgvs_parser = _worker_state['hgvs_parser']
+
+    try:
+        if isinstance(source, bytes):
+            data = load_phenopacket_json(source)
+        else:
+            with open(source, 'rb') as f:
+                data = load_phenopacket_json(f.read())
+    except ValueError as e:
+        label = source if isinstance(source, str) else "an NDJSON line"
+        logging.warning(f"Skipping {label}: Invalid PhenoPacket JSON: {e}")
+        return None
+
+    # --- Extract Patient Phenotypes ---
+    patient_hpo_ids = [pf['type']['id'] for pf in data.get('phenotypicFeatures', [])]
+    if not patient_hpo_ids:
+        logging.warning(f"Skipping {data['id']}: No phenotypic features found.")
+        return None
+
+    # --- Extract Ground Truth Gene or Disease ---
+    if target == 'genes':
+        ground_truth = extract_ground_truth_gene(data, hgvs_mapper, hgvs_parser)
+        kind = "gene symbol"
+    else:
+        ground_truth = extract_ground_truth_disease(data)
+        kind = "disease ID"
+
+    if ground_truth is None:
+        logging.warning(f"Skipping phenopacket '{data['id']}': Could not extract ground truth {kind}.")
+        return None
+
+    if not ground_truth:
+        logging.warning(f"Skipping phenopacket '{data['id']}': Ground truth {kind} is present but empty.")
+        return None
+
+    gt_idx = profiles.entity_index.get(ground_truth)
+    if gt_idx is None:
+        logging.warning(f"Skipping {data['id']}: Ground truth '{ground_truth}' not in HPO {target} profiles.")
+        return None
+
+    # --- Score all profiles by phenotype similarity ---
+    ranking_key = (similarity_method, frozenset(patient_hpo_ids))
+    scores = _ranking_cache.get(ranking_key)
+    if scores is not None:
+        _ranking_cache.move_to_end(ranking_key)
+    else:
+        # Resolve the terms only for usable phenopackets, straight to distinct term indices
+        term_index = term_tables.term_index
+        patient_idx = np.unique(np.fromiter(
+            (term_index[hpo_id] for hpo_id in patient_hpo_ids if hpo_id in term_index), dtype=np.int32
+        ))
+        if not len(patient_idx):
+            logging.warning(f"Skipping {data['id']}: None of its phenotypic features are known HPO terms.")
+            return None
+
+        scores = _score_patient_terms(patient_idx, similarity_method)
+        _ranking_cache[ranking_key] = scores
+        if len(_ranking_cache) > RANKING_CACHE_SIZE:
+            _ranking_cache.popitem(last=False)
     
-    return ranked_df
+    # --- Find Rank and ROC AUC of the correct entity (no full sort needed) ---
+    rank, roc_auc = rank_and_roc_auc(scores, gt_idx)
+    score = scores[gt_idx]
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        logging.debug(f"Top {target} for {data['id']}: {', '.join(profiles.entity_ids[top_k(scores)])}")
+
+    if len(scores) == 1: # ROC AUC requires both positive and negative samples
+        logging.warning(f"Cannot calculate ROC AUC for {data['id']}: only one class present.")
 
-def run_validation(phenopacket_dir, gene_profiles, similarity_method, hgvs_mapper, hgvs_parser):
+    return {
+        'phenopacket_id': data['id'],
+        'ground_truth_gene' if target == 'genes' else 'ground_truth_disease': ground_truth,
+        'rank': rank,
+        'score': score,
+        'num_hpo_terms': len(patient_hpo_ids),
+        'roc_auc': roc_auc
+    }
+
+
+def run_validation(phenopacket_dir, profiles, term_tables, similarity_method, hgvs_mapper, hgvs_parser, workers=1,
+                   mica_cache=None, target='genes', ndjson_path=None):
     """
-    Iterates through all PhenoPackets, performs similarity analysis against gene profiles,
-    and evaluates the ranking of the true causal gene.
+    Iterates through all PhenoPackets, performs similarity analysis against gene or disease
+    profiles, and evaluates the ranking of the true causal gene or diagnosis.
     
     Args:
         phenopacket_dir (str): Path to the directory containing PhenoPacket JSON files.
-        gene_profiles (dict): A dictionary of gene symbols to HPOSets.
+        profiles (PackedProfiles): The term indices of every gene or disease profile.
+        term_tables (TermTables): Precomputed term information content and ancestors.
         similarity_method (str): The similarity algorithm to use.
         hgvs_mapper (hgvs.assemblymapper.AssemblyMapper): Mapper for transcript to gene symbol.
         hgvs_parser (hgvs.parser.Parser): Parser for HGVS strings.
+        workers (int): Number of worker processes; 1 scores all PhenoPackets in this process.
+        mica_cache (str): Optional path of a MICA matrix saved by ensure_mica_matrix for the
+                          profile terms, read instead of walking the term ancestors.
+        target (str): What the profiles describe and the PhenoPackets are ranked against,
+                      'genes' or 'diseases'.
+        ndjson_path (str): Optional NDJSON corpus written by validate_phenopackets.py --ndjson,
+                           read instead of the PhenoPacket files in phenopacket_dir.
         
     Returns:
         pandas.DataFrame: A DataFrame with detailed validation results for each phenopacket.
     """
-    phenopacket_files = [f for f in os.listdir(phenopacket_dir) if f.endswith('.json')]
+    if ndjson_path:
+        # One sequential read of the whole corpus instead of an open/read/close per PhenoPacket
+        logging.info(f"Reading PhenoPackets from {ndjson_path}")
+        with open(ndjson_path, 'rb') as f:
+            phenopacket_sources = [line for line in f if line.strip()]
+    else:
+        with os.scandir(phenopacket_dir) as entries:
+            phenopacket_sources = [entry.path for entry in entries if entry.name.endswith('.json') and entry.is_file()]
     
-    results = []
+    mica = mica_columns = None
+    if mica_cache:
+        mica, mica_columns = load_mica_matrix(mica_cache)
+        # Profile terms now index the MICA matrix columns rather than all HPO terms
+        profiles = replace(profiles, terms=np.searchsorted(mica_columns, profiles.terms).astype(np.int32))
+    
+    _worker_state.update(
+        profiles=profiles,
+        target=target,
+        mica=mica,
+        mica_columns=mica_columns,
+        term_tables=term_tables,
+        similarity_method=similarity_method,
+        hgvs_mapper=hgvs_mapper,
+        hgvs_parser=hgvs_parser,
+    )
+    # Cached scores are only valid for the profiles and term tables they were computed from
+    _cached_term_similarity_row.cache_clear()
+    _ranking_cache.clear()
     
     with logging_redirect_tqdm():
-        for filename in tqdm(phenopacket_files, desc="Validating PhenoPackets"):
-            filepath = os.path.join(phenopacket_dir, filename)
-            with open(filepath, 'r') as f:
-                data = json.load(f)
-                
-            # --- Extract Patient Phenotypes ---
-            patient_hpo_ids = [pf['type']['id'] for pf in data.get('phenotypicFeatures', [])]
-            if not patient_hpo_ids:
-                logging.warning(f"Skipping {data['id']}: No phenotypic features found.")
-                continue
-            patient_hpo_set = HPOSet.from_queries(patient_hpo_ids)
-            
-            # --- Extract Ground Truth Gene ---
-            ground_truth_gene = None
-            interpretations = data.get('interpretations', [])
-            if interpretations:
-                # Path: Interpretation -> diagnosis -> genomicInterpretations -> variantInterpretation -> variationDescriptor -> geneContext
-                try:
-                    gene_context = interpretations[0]['diagnosis']['genomicInterpretations'][0]['variantInterpretation']['variationDescriptor']['geneContext']
-                    ground_truth_gene = gene_context.get('symbol')
-                except (KeyError, IndexError):
-                    pass  # No geneContext found, will try HGVS parsing next.
-
-                # Fallback: If no geneContext, try parsing HGVS expression from transcript ID
-                if ground_truth_gene is None and hgvs_mapper:
-                    try:
-                        var_descriptor = interpretations[0]['diagnosis']['genomicInterpretations'][0]['variantInterpretation']['variationDescriptor']
-                        expressions = var_descriptor.get('expressions', [])
-                        if expressions:
-                            # Use the first available HGVS string
-                            hgvs_string = expressions[0].get('value')
-                            if hgvs_string:
-                                try:
-                                    variant = hgvs_parser.parse(hgvs_string)
-                                    transcript_id = variant.ac
-                                    try:
-                                        # Use the data provider (hdp) associated with the mapper to get transcript identity info
-                                        tx_identity_info = hgvs_mapper.hdp.get_tx_identity_info(transcript_id)
-                                        # The hgnc gene symbol is at index 2 of the returned tuple.
-                                        if tx_identity_info and len(tx_identity_info) > 2 and tx_identity_info[2]:
-                                            ground_truth_gene = tx_identity_info[2]
-                                        
-                                        if ground_truth_gene:
-                                            logging.debug(f"Mapped transcript '{transcript_id}' to gene '{ground_truth_gene}' for {data['id']}.")
-                                    except hgvs.exceptions.HGVSDataNotAvailableError as e:
-                                        logging.warning(f"Could not map transcript '{transcript_id}' in {data['id']}: {e}")
-                                except hgvs.exceptions.HGVSParseError as e:
-                                    logging.warning(f"Could not parse HGVS string '{hgvs_string}' in {data['id']}: {e}")
-                    except (KeyError, IndexError):
-                        pass # Path to expressions not found
-
-            if ground_truth_gene is None:
-                logging.warning(f"Skipping phenopacket '{data['id']}': Could not extract ground truth gene symbol from interpretations.")
-                continue
-
-            if not ground_truth_gene:
-                logging.warning(f"Skipping phenopacket '{data['id']}': Ground truth gene symbol is present but empty.")
-                continue
-
-            if ground_truth_gene not in gene_profiles:
-                logging.warning(f"Skipping {data['id']}: Ground truth gene '{ground_truth_gene}' not in HPO gene profiles.")
-                continue
-
-            # --- Rank all genes by phenotype similarity ---
-            ranked_genes_df = calculate_similarity_ranking(patient_hpo_set, gene_profiles, similarity_method)
-            
-            # --- Find Rank of the correct gene ---
-            rank_info = ranked_genes_df[ranked_genes_df['entity_id'] == ground_truth_gene]
-            rank = rank_info.index[0] + 1 if not rank_info.empty else float('inf')
-            score = rank_info['similarity_score'].iloc[0] if not rank_info.empty else 0.0
-
-            # --- Calculate ROC AUC for this ranking ---
-            y_true = (ranked_genes_df['entity_id'] == ground_truth_gene).astype(int).tolist()
-            y_score = ranked_genes_df['similarity_score'].tolist()
-            
-            roc_auc = float('nan')
-            if len(set(y_true)) > 1: # Requires both positive and negative samples
-                roc_auc = roc_auc_score(y_true, y_score)
-            else:
-                logging.warning(f"Cannot calculate ROC AUC for {data['id']}: only one class present.")
-
-            results.append({
-                'phenopacket_id': data['id'],
-                'ground_truth_gene': ground_truth_gene,
-                'rank': rank,
-                'score': score,
-                'num_hpo_terms': len(patient_hpo_ids),
-                'roc_auc': roc_auc
-            })
+        if workers > 1:
+            # Under fork the initializer arguments are inherited rather than pickled;
+            # other start methods receive them once per worker instead of per task
+            shared_state = {
+                'profiles': profiles,
+                'target': target,
+                'term_tables': term_tables,
+                'similarity_method': similarity_method,
+                'hgvs_mapper': None,
+                # The matrix itself is reopened from disk rather than pickled
+                'mica_cache': mica_cache,
+                'mica_columns': mica_columns,
+            }
+            with multiprocessing.Pool(workers, initializer=_init_worker, initargs=(shared_state, hgvs_mapper is not None)) as pool:
+                outcomes = list(tqdm(
+                    pool.imap_unordered(score_phenopacket, phenopacket_sources, chunksize=8),
+                    total=len(phenopacket_sources),
+                    desc="Validating PhenoPackets"
+                ))
+        else:
+            outcomes = [score_phenopacket(f) for f in tqdm(phenopacket_sources, desc="Validating PhenoPackets")]
         
-    return pd.DataFrame(results)
+    return pd.DataFrame([result for result in outcomes if result is not None])
 
 def calculate_performance_metrics(results_df):
     """
@@ -213,14 +786,13 @@ def calculate_performance_metrics(results_df):
             "message": "No valid cases were found to evaluate."
         }
 
-    # Calculate Hits@k
-    hits_at_1 = (results_df['rank'] == 1).sum() / total_cases
-    hits_at_10 = (results_df['rank'] <= 10).sum() / total_cases
-    hits_at_100 = (results_df['rank'] <= 100).sum() / total_cases
+    # Calculate Hits@k from one sort of the ranks: cases ranked <= k are a prefix of it
+    sorted_ranks = np.sort(results_df['rank'].to_numpy())
+    hits_at_1, hits_at_10, hits_at_100 = np.searchsorted(sorted_ranks, [1, 10, 100], side='right') / total_cases
     
     # Calculate Mean ROC AUC, ignoring NaNs
     mean_roc_auc = results_df['roc_auc'].mean()
-    median_rank = results_df['rank'].median()
+    median_rank = np.median(sorted_ranks)
 
     metrics = {
         "total_cases_evaluated": total_cases,
@@ -232,22 +804,30 @@ def calculate_performance_metrics(results_df):
     }
     return metrics
 
-def main(phenopacket_dir, output_json_path, similarity_method):
+def main(phenopacket_dir, output_json_path, similarity_method, workers=1, mica_cache=None, profile_cache=None,
+         target='genes', check_parity=False, ndjson_path=None):
     """
     Main function to run the phenotypic similarity validation pipeline.
     """
-    gene_profiles = load_gene_hpo_profiles()
+    term_tables, profiles = load_term_tables_and_profiles(target, profile_cache)
     
-    if not gene_profiles:
-        logging.error("Gene profiles could not be loaded. Exiting.")
+    if not len(profiles.entity_ids):
+        logging.error(f"Profiles for {target} could not be loaded. Exiting.")
         return
 
-    # Initialize mappers for HGVS parsing and gene symbol mapping
-    hgvs_mapper = initialize_hgvs_mapper()
+    if check_parity:
+        check_pyhpo_parity(term_tables, profiles)
+
+    if mica_cache:
+        ensure_mica_matrix(mica_cache, term_tables, np.unique(profiles.terms))
+
+    # Initialize mappers for HGVS parsing and gene symbol mapping; only gene ground truths need them
+    hgvs_mapper = initialize_hgvs_mapper() if target == 'genes' else None
     hgvs_parser = hgvs.parser.Parser()
 
     validation_results_df = run_validation(
-        phenopacket_dir, gene_profiles, similarity_method, hgvs_mapper, hgvs_parser
+        phenopacket_dir, profiles, term_tables, similarity_method, hgvs_mapper, hgvs_parser,
+        workers=workers, mica_cache=mica_cache, target=target, ndjson_path=ndjson_path
     )
     
     if validation_results_df.empty:
@@ -256,7 +836,12 @@ def main(phenopacket_dir, output_json_path, similarity_method):
 
     # Save detailed results to JSON
     logging.info(f"Saving detailed validation results to {output_json_path}")
-    validation_results_df.to_json(output_json_path, orient='records', indent=4)
+    with open(output_json_path, 'wb') as f:
+        # orjson writes NaN (e.g., an undefined ROC AUC) as null, like to_json did
+        f.write(orjson.dumps(
+            validation_results_df.to_dict(orient='records'),
+            option=orjson.OPT_INDENT_2 | orjson.OPT_SERIALIZE_NUMPY
+        ))
     
     # Calculate and display performance metrics
     performance_metrics = calculate_performance_metrics(validation_results_df)
@@ -273,12 +858,27 @@ if __name__ == "__main__":
         default="phenopackets",
         help="Directory containing the PhenoPacket JSON files."
     )
+    parser.add_argument(
+        "--ndjson",
+        type=str,
+        default=None,
+        help="Read the PhenoPackets from this NDJSON corpus (written by validate_phenopackets.py "
+             "--ndjson) instead of the files in --phenopacket_dir."
+    )
     parser.add_argument(
         "--output_json",
         type=str,
         default="phenotypic_validation_results.json",
         help="Path to save the detailed validation results JSON file."
     )
+    parser.add_argument(
+        "--target",
+        type=str,
+        default="genes",
+        choices=list(PROFILE_LOADERS),
+        help="Rank each PhenoPacket's causal gene against gene profiles, or its diagnosis "
+             "against OMIM disease profiles. Defaults to 'genes'."
+    )
     parser.add_argument(
         "--similarity_method",
         type=str,
@@ -286,6 +886,32 @@ if __name__ == "__main__":
         choices=['resnik', 'lin', 'jc', 'rel'],
         help="The similarity algorithm to use. Defaults to 'resnik'."
     )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=os.cpu_count(),
+        help="Number of worker processes used to score PhenoPackets. Defaults to the number of CPUs."
+    )
+    parser.add_argument(
+        "--mica_cache",
+        type=str,
+        default=None,
+        help="Optional .npy file holding the precomputed MICA of every HPO term against the profile terms. "
+             "Built on first use; later runs memory-map it instead of walking term ancestors."
+    )
+    parser.add_argument(
+        "--profile_cache",
+        type=str,
+        default=None,
+        help="Pickle file caching the HPO term tables and profiles between runs. Rebuilt when the "
+             "target or HPO release changes. Defaults to '.gene_profiles.pkl' or '.disease_profiles.pkl'."
+    )
+    parser.add_argument(
+        "--check_parity",
+        action="store_true",
+        help="Before validating, check the vectorized similarity scores against pyhpo's "
+             "HPOSet.similarity for every similarity method on a sample of the profiles."
+    )
     parser.add_argument(
         "-v", "--verbose",
         action="store_true",
@@ -323,4 +949,10 @@ if __name__ == "__main__":
         phenopacket_dir=args.phenopacket_dir,
         output_json_path=args.output_json,
         similarity_method=args.similarity_method,
+        workers=args.workers,
+        mica_cache=args.mica_cache,
+        profile_cache=args.profile_cache or f".{args.target[:-1]}_profiles.pkl",
+        target=args.target,
+        check_parity=args.check_parity,
+        ndjson_path=args.ndjson,
     )
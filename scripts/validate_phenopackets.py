@@ -3,11 +3,16 @@
 Phenopackets validator following phenopacket-tools validation workflow
 """
 
+import argparse
 import json
+import os
 import sys
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional, BinaryIO, Iterator
 from dataclasses import dataclass
 
+import ijson
+import orjson
+
 
 @dataclass
 class ValidationError:
@@ -154,72 +159,114 @@ class PhenopacketValidator:
             )
 
 
-def validate_phenopackets_file(file_path: str) -> bool:
-    """Validate phenopackets from JSON file"""
-    print(f"Validating {file_path}...")
-    print("=" * 60)
+def iter_phenopackets(f: BinaryIO) -> Iterator[Dict[str, Any]]:
+    """Yield phenopackets from a JSON file holding one phenopacket or an array of them.
+    Arrays are streamed one item at a time, so a large corpus is never fully in memory.
+    Files with NaN/Infinity constants, which json.dump writes for missing values but
+    ijson and orjson reject, are re-read with the json module from where parsing stopped."""
+    first = f.read(1)
+    while first.isspace():
+        first = f.read(1)
+    f.seek(0)
     
+    count = 0
     try:
-        with open(file_path, 'r') as f:
-            data = json.load(f)
-    except json.JSONDecodeError as e:
-        print(f"❌ Invalid JSON: {e}")
-        return False
-    
-    # Handle both single phenopacket and array
-    phenopackets = data if isinstance(data, list) else [data]
+        if first == b'[':
+            for pp in ijson.items(f, 'item', use_float=True):
+                yield pp
+                count += 1
+        else:
+            yield orjson.loads(f.read())
+            count += 1
+    except (orjson.JSONDecodeError, ijson.JSONError):
+        f.seek(0)
+        data = json.load(f)
+        yield from data[count:] if isinstance(data, list) else [data][count:]
+
+
+def validate_phenopackets_file(file_path: str, ndjson_path: Optional[str] = None, verbose: bool = False) -> bool:
+    """Validate phenopackets from JSON file, optionally writing them to an NDJSON sidecar"""
+    print(f"Validating {file_path}...")
+    print("=" * 60)
     
     validator = PhenopacketValidator()
+    total = 0
     total_errors = 0
     total_warnings = 0
     valid_count = 0
     
-    for i, pp in enumerate(phenopackets):
-        pp_id = pp.get('id', f'phenopacket_{i+1}')
-        is_valid = validator.validate_phenopacket(pp, pp_id)
-        
-        if is_valid:
-            valid_count += 1
-        
-        total_errors += len(validator.errors)
-        total_warnings += len(validator.warnings)
-        
-        # Print first few errors/warnings
-        if i < 5:  # Only show details for first 5
-            if validator.errors:
-                print(f"\n❌ Errors in {pp_id}:")
-                for error in validator.errors[:3]:  # Show first 3 errors
-                    print(f"   - {error.field}: {error.message}")
-            
-            if validator.warnings:
-                print(f"\n⚠️  Warnings in {pp_id}:")
-                for warning in validator.warnings[:3]:
-                    print(f"   - {warning.field}: {warning.message}")
+    # Write phenopackets one per line, so consumers can read a whole corpus from one file.
+    # The sidecar is written to a temporary file and only moved into place once the whole
+    # input has been read, so a parse failure never leaves a truncated corpus behind.
+    tmp_ndjson_path = f"{ndjson_path}.tmp" if ndjson_path else None
+    ndjson_file = open(tmp_ndjson_path, 'wb') if ndjson_path else None
+    try:
+        with open(file_path, 'rb') as f:
+            for i, pp in enumerate(iter_phenopackets(f)):
+                total += 1
+                pp_id = pp.get('id', f'phenopacket_{i+1}')
+                is_valid = validator.validate_phenopacket(pp, pp_id)
+                
+                if is_valid:
+                    valid_count += 1
+                
+                total_errors += len(validator.errors)
+                total_warnings += len(validator.warnings)
+                
+                # Print first few errors/warnings, or all of them when verbose
+                if verbose or i < 5:  # Only show details for first 5
+                    if validator.errors:
+                        print(f"\n❌ Errors in {pp_id}:")
+                        for error in validator.errors if verbose else validator.errors[:3]:  # Show first 3 errors
+                            print(f"   - {error.field}: {error.message}")
+                    
+                    if validator.warnings:
+                        print(f"\n⚠️  Warnings in {pp_id}:")
+                        for warning in validator.warnings if verbose else validator.warnings[:3]:
+                            print(f"   - {warning.field}: {warning.message}")
+                
+                if ndjson_file:
+                    ndjson_file.write(orjson.dumps(pp) + b'\n')
+    except (ValueError, ijson.JSONError) as e:
+        print(f"❌ Invalid JSON: {e}")
+        if ndjson_file:
+            ndjson_file.close()
+            os.remove(tmp_ndjson_path)
+        return False
+    
+    if ndjson_file:
+        ndjson_file.close()
+        os.replace(tmp_ndjson_path, ndjson_path)
+        print(f"\nWrote {total} phenopackets to {ndjson_path}")
     
     # Summary
     print("\n" + "=" * 60)
     print("Validation Summary")
     print("=" * 60)
-    print(f"Total phenopackets: {len(phenopackets)}")
-    print(f"Valid: {valid_count} ({valid_count/len(phenopackets)*100:.1f}%)")
-    print(f"With errors: {len(phenopackets) - valid_count} ({(len(phenopackets)-valid_count)/len(phenopackets)*100:.1f}%)")
+    print(f"Total phenopackets: {total}")
+    print(f"Valid: {valid_count} ({valid_count/total*100:.1f}%)")
+    print(f"With errors: {total - valid_count} ({(total-valid_count)/total*100:.1f}%)")
     print(f"Total errors: {total_errors}")
     print(f"Total warnings: {total_warnings}")
     
-    if valid_count == len(phenopackets):
+    if valid_count == total:
         print("\n✅ All phenopackets are valid!")
         return True
     else:
-        print(f"\n⚠️  {len(phenopackets) - valid_count} phenopackets have validation errors")
+        print(f"\n⚠️  {total - valid_count} phenopackets have validation errors")
         return False
 
 
 if __name__ == "__main__":
-    if len(sys.argv) < 2:
-        print("Usage: python validate_phenopackets_proper.py <phenopackets.json>")
-        sys.exit(1)
+    parser = argparse.ArgumentParser(description="Validate Phenopackets schema compliance and data quality")
+    parser.add_argument("file", help="Phenopackets JSON file to validate")
+    parser.add_argument("-v", "--verbose", action="store_true",
+                        help="Show all errors and warnings for every phenopacket")
+    parser.add_argument("--ndjson", metavar="PATH",
+                        help="Also write the phenopackets to PATH as newline-delimited JSON, "
+                             "to be read by similarity.py --ndjson")
+    args = parser.parse_args()
     
-    file_path = sys.argv[1]
-    is_valid = validate_phenopackets_file(file_path)
+    is_valid = validate_phenopackets_file(args.file, ndjson_path=args.ndjson, verbose=args.verbose)
     
     sys.exit(0 if is_valid else 1)
\ No newline at end of file
@@ -0,0 +1,89 @@
+import os
+import sys
+
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'scripts'))
+
+import process_and_merge_pavs as pavs
+
+
+LITERATURE_ROWS = [
+    ['id', 'patient_gender', 'patient_age', 'reference', 'test', 'test_strategy', 'consanguinity',
+     'family_id', 'number_of_family_members', 'cohort_size', 'phenotypes', 'result', 'result_comment',
+     'variants', 'zygosity', 'pathogenicity'],
+    ['1', 'Male', '3y', 'https://pubmed.ncbi.nlm.nih.gov/1/', 'WES', 'Trio', 'Yes',
+     'F1', '4', '10', 'Seizures (HP:0001250)', 'Positive', '', 'c.1A>G', 'Homozygous', 'Pathogenic'],
+    # Blank categorical (sex, consanguinity, pathogenicity) and integer (family members) cells
+    ['2', '', '5y', 'https://pubmed.ncbi.nlm.nih.gov/1/', 'WES', 'Singleton', '',
+     'F2', '', '10', 'Ataxia HP:0001251, HP:0001250', 'Positive', '', 'c.2A>G', 'Heterozygous', ''],
+    # Excluded reference, covered by the clinical literature dataset
+    ['3', 'Female', '', 'https://pubmed.ncbi.nlm.nih.gov/28600779/', 'WES', 'Trio', 'No',
+     'F3', '2', '', 'Hypotonia', 'Negative', '', '', '', ''],
+]
+
+CLINICAL_LITERATURE_ROWS = [
+    ['ID', 'Testing Strategy', 'Gender', 'Age', 'Test', 'Consanguinity', 'Family hx', 'Result',
+     'Zyogsity', 'Phenotype', 'Variant(s)', 'HGMD'],
+    ['1', 'WES', 'Male', '2y', 'Exome', 'Yes', 'None', 'Positive', 'Homozygous',
+     'Seizures HP:0001250', 'c.1A>G', 'DM'],
+    ['2', '', '', '', 'Exome', '', '', 'Negative', '', '', '', ''],
+]
+
+
+def write_tsv(path, rows):
+    path.write_text(''.join('\t'.join(row) + '\n' for row in rows), encoding='latin-1')
+    return str(path)
+
+
+@pytest.fixture
+def literature_tsv(tmp_path):
+    return write_tsv(tmp_path / 'literature.tsv', LITERATURE_ROWS)
+
+
+@pytest.fixture
+def clinical_literature_tsv(tmp_path):
+    return write_tsv(tmp_path / 'clinical_literature.tsv', CLINICAL_LITERATURE_ROWS)
+
+
+def assert_string_categories(data):
+    for col in pavs.LOW_CARDINALITY_COLUMNS:
+        assert isinstance(data[col].dtype, pd.CategoricalDtype), col
+        assert data[col].cat.categories.dtype == object, col
+
+
+def test_process_literature_data_with_blank_cells(literature_tsv):
+    data = pavs.process_literature_data(literature_tsv)
+
+    assert list(data['ID']) == [1, 2]
+    assert_string_categories(data)
+    assert data['gender'].isna().tolist() == [False, True]
+    assert data['consanguinity'].isna().tolist() == [False, True]
+    assert data['pathogenicity'].isna().tolist() == [False, True]
+    assert data['number_of_family_members'].isna().tolist() == [False, True]
+    assert list(data['HPO_ID']) == ['HP:0001250', 'HP:0001251,HP:0001250']
+
+
+def test_process_clinical_literature_data_with_blank_cells(clinical_literature_tsv):
+    data = pavs.process_clinical_literature_data(clinical_literature_tsv)
+
+    assert len(data) == 2
+    assert_string_categories(data)
+    assert data['gender'].isna().tolist() == [False, True]
+    assert data['test_strategy'].isna().tolist() == [False, True]
+    assert list(data['HPO_ID']) == ['HP:0001250', '']
+
+
+def test_processed_datasets_combine_from_cache(literature_tsv, clinical_literature_tsv):
+    pavs.load_cached(pavs.process_literature_data, literature_tsv)
+    # The second load reads the Parquet cache back
+    data1 = pavs.load_cached(pavs.process_literature_data, literature_tsv)
+    data2 = pavs.load_cached(pavs.process_clinical_literature_data, clinical_literature_tsv)
+
+    assert_string_categories(data1)
+    combined = pavs.concat_datasets([pavs.fill_not_reported(data) for data in (data1, data2)])
+
+    assert len(combined) == 4
+    assert all(isinstance(combined[col].dtype, pd.CategoricalDtype) for col in pavs.LOW_CARDINALITY_COLUMNS)
+    assert list(combined['gender']) == ['Male', 'Not reported', 'Male', 'Not reported']